@@ -2,6 +2,8 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from .company import *
+from .configuration import *
 from .move import *
 from .purchase_request import *
 from .shipment import *
@@ -11,12 +13,17 @@ from .production import *
 
 def register():
     Pool.register(
+        Company,
+        Currency,
+        Configuration,
         MoveExtraProduct,
+        MoveExtraProductQueue,
         Move,
         PurchaseRequest,
         ShipmentOut,
         BOMInputExtraProduct,
         BOMOutputExtraProduct,
+        BOM,
         BOMInput,
         BOMOutput,
         Production,
@@ -1,13 +1,15 @@
 # This file is part of the stock_move_extra_products_supply module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from decimal import Decimal
+from trytond import backend
 from trytond.model import ModelView, ModelSQL, fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from .move import ExtraProductMixin
 
 __all__ = [
     'BOMInputExtraProduct', 'BOMOutputExtraProduct',
-    'BOMInput', 'BOMOutput',
+    'BOM', 'BOMInput', 'BOMOutput',
     ]
 
 
@@ -15,14 +17,110 @@ class BOMInputExtraProduct(ModelSQL, ModelView, ExtraProductMixin):
     'BOM Input Extra Product'
     __name__ = 'production.bom.input.extra_product'
     bom_input = fields.Many2One('production.bom.input', 'BOM Input',
-        required=True, ondelete='CASCADE')
+        required=True, select=True, ondelete='CASCADE')
 
 
 class BOMOutputExtraProduct(ModelSQL, ModelView, ExtraProductMixin):
     'BOM Output Extra Product'
     __name__ = 'production.bom.output.extra_product'
     bom_output = fields.Many2One('production.bom.output', 'BOM Output',
-        required=True, ondelete='CASCADE')
+        required=True, select=True, ondelete='CASCADE')
+
+
+class BOM:
+    __metaclass__ = PoolMeta
+    __name__ = 'production.bom'
+
+    @classmethod
+    def __setup__(cls):
+        super(BOM, cls).__setup__()
+        cls._error_messages.update({
+                'recursive_extra_products': ('The BOM "%(bom)s" can not '
+                    'be exploded to get its extra products because it is '
+                    'used by its own inputs.'),
+                })
+
+    def explode_extra_products(self, memo=None, path=None):
+        """Return the extra products of the BOM inputs and outputs
+
+        The result is a dictionary with the key ('input' or 'output', product
+        id) and the list of extra product values for the BOM quantities. The
+        inputs produced with their own BOM get the extra products of the
+        inputs of that BOM and of its output of the input product too, scaled
+        by the input quantity. The by-products of that BOM are not rolled up
+        and an input produced by the BOM itself is not exploded again.
+
+        memo is a dictionary shared between calls to explode each BOM once.
+        """
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        if memo is None:
+            memo = {}
+        if path is None:
+            path = ()
+        if self.id in path:
+            self.raise_user_error('recursive_extra_products', {
+                    'bom': self.rec_name,
+                    })
+        if self.id in memo:
+            return memo[self.id]
+
+        result = {}
+        for type_, lines in (('input', self.inputs), ('output', self.outputs)):
+            for line in lines:
+                key = (type_, line.product.id)
+                if key in result:
+                    continue
+                extras = [e._get_copy_values() for e in line.extra_products]
+                child = None
+                if type_ == 'input' and line.product.boms:
+                    child = line.product.boms[0].bom
+                if child and child != self:
+                    child_extras = child.explode_extra_products(memo,
+                        path + (self.id,))
+                    for output in child.outputs:
+                        if output.product == line.product and output.quantity:
+                            factor = Uom.compute_qty(line.uom, line.quantity,
+                                output.uom, round=False) / output.quantity
+                            break
+                    else:
+                        factor = 0
+                    if factor:
+                        for (child_type, product), values in (
+                                child_extras.items()):
+                            if (child_type == 'output'
+                                    and product != line.product.id):
+                                continue
+                            extras.extend(scale_extra_values(e, factor)
+                                for e in values)
+                result[key] = merge_extra_values(extras)
+        memo[self.id] = result
+        return result
+
+
+def scale_extra_values(values, factor):
+    'Return the extra product values with quantity and cost scaled by factor'
+    values = values.copy()
+    values['quantity'] *= factor
+    if values.get('cost_price') is not None:
+        values['cost_price'] *= Decimal(str(factor))
+    return values
+
+
+def merge_extra_values(extras):
+    'Sum the quantity and cost of the extra product values by product and uom'
+    merged = {}
+    for values in extras:
+        key = (values['product'], values['uom'])
+        if key not in merged:
+            merged[key] = values.copy()
+            continue
+        values_ = merged[key]
+        values_['quantity'] += values['quantity']
+        if values.get('cost_price') is not None:
+            values_['cost_price'] = ((values_.get('cost_price') or Decimal(0))
+                + values['cost_price'])
+    return [merged[k] for k in sorted(merged, key=lambda k: (k[0], k[1]))]
 
 
 class BOMInput:
@@ -32,6 +130,14 @@ class BOMInput:
         'bom_input', 'Extra products',
         help="Additional services from which create purchase requests.")
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        super(BOMInput, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        # Index to find the lines of the BOM for a product
+        table.index_action(['bom', 'product'], 'add')
+
     def get_rec_name(self, name):
         return ("%s%s %s"
             % (self.quantity, self.uom.symbol, self.product.rec_name))
@@ -44,6 +150,14 @@ class BOMOutput:
         'bom_output', 'Extra products',
         help="Additional services from which create purchase requests.")
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        super(BOMOutput, cls).__register__(module_name)
+        table = TableHandler(cls, module_name)
+        # Index to find the lines of the BOM for a product
+        table.index_action(['bom', 'product'], 'add')
+
     def get_rec_name(self, name):
         return ("%s%s %s"
             % (self.quantity, self.uom.symbol, self.product.rec_name))
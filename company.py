@@ -0,0 +1,32 @@
+# This file is part of the stock_move_extra_products_supply module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+from .move import ExtraProductMixin
+
+__all__ = ['Company', 'Currency']
+
+
+class Company:
+    __metaclass__ = PoolMeta
+    __name__ = 'company.company'
+
+    @classmethod
+    def write(cls, *args):
+        super(Company, cls).write(*args)
+        ExtraProductMixin._currency_digits_cache.clear()
+
+
+class Currency:
+    __metaclass__ = PoolMeta
+    __name__ = 'currency.currency'
+
+    @classmethod
+    def write(cls, *args):
+        super(Currency, cls).write(*args)
+        ExtraProductMixin._currency_digits_cache.clear()
+
+    @classmethod
+    def delete(cls, currencies):
+        super(Currency, cls).delete(currencies)
+        ExtraProductMixin._currency_digits_cache.clear()
@@ -0,0 +1,25 @@
+# This file is part of the stock_move_extra_products_supply module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import PoolMeta
+
+__all__ = ['Configuration']
+
+
+class Configuration:
+    __metaclass__ = PoolMeta
+    __name__ = 'stock.configuration'
+    extra_products_group_requests = fields.Boolean(
+        'Group Extra Products Requests',
+        help="Create a single purchase request for the extra products with "
+        "the same product, supplier, warehouse, company and supply date.")
+    extra_products_async_requests = fields.Boolean(
+        'Queue Extra Products Requests',
+        help="Queue the moves when they are assigned or done and create the "
+        "purchase requests of their extra products later from the scheduler.")
+    extra_products_from_bom = fields.Boolean(
+        'Add BOM Extra Products to Productions',
+        help="Add the extra products of the BOM to the inputs and outputs "
+        "of the productions scaled to their quantity, and update them when "
+        "the quantity changes.")
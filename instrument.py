@@ -0,0 +1,162 @@
+# This file is part of the stock_move_extra_products_supply module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import time
+from contextlib import contextmanager
+
+from trytond.transaction import Transaction
+
+__all__ = ['QueryCounter', 'measure', 'MeasureAccumulator', 'accumulate']
+
+logger = logging.getLogger(__name__)
+
+STATS_CONTEXT_KEY = 'extra_products_supply_stats'
+
+
+class _CountingCursor(object):
+    'Cursor that reports the executed queries to its counter'
+
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def execute(self, query, params=None):
+        if params is None:
+            result = self._cursor.execute(query)
+        else:
+            result = self._cursor.execute(query, params)
+        self._counter.queries += 1
+        if query.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            self._counter.rows += max(self._cursor.rowcount, 0)
+        return result
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class QueryCounter(object):
+    'Connection proxy counting the queries and the rows written'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.queries = 0
+        self.rows = 0
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self,
+            self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def _is_enabled(transaction):
+    return (transaction.context.get(STATS_CONTEXT_KEY) is not None
+        or logger.isEnabledFor(logging.INFO))
+
+
+@contextmanager
+def _counting(transaction):
+    'Yield the query counter of the transaction connection'
+    connection = transaction.connection
+    if isinstance(connection, QueryCounter):
+        yield connection
+        return
+    counter = transaction.connection = QueryCounter(connection)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+def _report(transaction, phase, calls, records, duration, queries, rows):
+    logger.info('%s: %d records in %.3fs, %d queries, %d rows written',
+        phase, records, duration, queries, rows)
+    stats = transaction.context.get(STATS_CONTEXT_KEY)
+    if stats is not None:
+        phase_stats = stats.setdefault(phase, {
+                'calls': 0,
+                'records': 0,
+                'duration': 0.,
+                'queries': 0,
+                'rows': 0,
+                })
+        phase_stats['calls'] += calls
+        phase_stats['records'] += records
+        phase_stats['duration'] += duration
+        phase_stats['queries'] += queries
+        phase_stats['rows'] += rows
+
+
+@contextmanager
+def measure(phase, records=0):
+    """Measure the duration, the queries and the rows written by the block
+
+    The measure is logged at INFO level and it is added to the dictionary of
+    the context key extra_products_supply_stats if it is set. Nothing is
+    measured when none of them is enabled.
+    """
+    transaction = Transaction()
+    if not _is_enabled(transaction):
+        yield
+        return
+
+    with _counting(transaction) as counter:
+        queries, rows = counter.queries, counter.rows
+        start = time.time()
+        try:
+            yield
+        finally:
+            _report(transaction, phase, 1, records, time.time() - start,
+                counter.queries - queries, counter.rows - rows)
+
+
+class MeasureAccumulator(object):
+    """Accumulate the measures of a phase run for each record of a loop
+
+    The sum of the measures is logged and added to the statistics once by
+    report, like measure does for a single block.
+    """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.calls = self.records = self.queries = self.rows = 0
+        self.duration = 0.
+
+    @contextmanager
+    def measure(self, records=1):
+        transaction = Transaction()
+        if not _is_enabled(transaction):
+            yield
+            return
+
+        with _counting(transaction) as counter:
+            queries, rows = counter.queries, counter.rows
+            start = time.time()
+            try:
+                yield
+            finally:
+                self.calls += 1
+                self.records += records
+                self.duration += time.time() - start
+                self.queries += counter.queries - queries
+                self.rows += counter.rows - rows
+
+    def report(self):
+        if self.calls:
+            _report(Transaction(), self.phase, self.calls, self.records,
+                self.duration, self.queries, self.rows)
+
+
+@contextmanager
+def accumulate(accumulator, records=1):
+    'Measure the block with the accumulator if it is not None'
+    if accumulator is None:
+        yield
+        return
+    with accumulator.measure(records):
+        yield
@@ -1,18 +1,40 @@
 # This file is part of the stock_move_extra_products_supply module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import logging
+import zlib
 from decimal import Decimal
+from sql import Cast, Literal, Null
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce, NullIf
+from sql.functions import Function
+from sql.operators import Exists
+from trytond import backend
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pyson import Eval, In
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
-__all__ = ['MoveExtraProduct', 'Move']
+from trytond.modules.product import price_digits
+from .instrument import measure, accumulate, MeasureAccumulator
+__all__ = ['MoveExtraProduct', 'MoveExtraProductQueue', 'Move']
+
+logger = logging.getLogger(__name__)
 
 
 STATES = {
     'readonly': In(Eval('state'), ['cancel', 'assigned', 'done']),
 }
 
+# Key of the advisory locks taken on the extra products ids
+PURCHASE_REQUEST_LOCK = zlib.crc32(b'stock.move.extra_product') & 0x7fffffff
+
+
+class TryAdvisoryXactLock(Function):
+    __slots__ = ()
+    _function = 'PG_TRY_ADVISORY_XACT_LOCK'
+
 
 class ExtraProductMixin:
     'Generic Extra Product'
@@ -21,14 +43,14 @@ class ExtraProductMixin:
         domain=[('purchasable', '=', True)])
     product_uom_category = fields.Function(
         fields.Many2One('product.uom.category', 'Product Uom Category'),
-        'on_change_with_product_uom_category')
+        'get_product_uom_category')
     uom = fields.Many2One('product.uom', 'Uom', required=True,
         domain=[
             ('category', '=', Eval('product_uom_category')),
             ],
         depends=['product_uom_category'])
     unit_digits = fields.Function(fields.Integer('Unit Digits'),
-        'on_change_with_unit_digits')
+        'get_unit_digits')
     quantity = fields.Float('Quantity', required=True,
         digits=(16, Eval('unit_digits', 2)),
         depends=['unit_digits'])
@@ -36,7 +58,9 @@ class ExtraProductMixin:
         digits=(16, Eval('currency_digits', 2)),
         depends=['currency_digits'])
     currency_digits = fields.Function(fields.Integer('Currency Digits'),
-        'on_change_with_currency_digits')
+        'get_currency_digits')
+    _currency_digits_cache = Cache(
+        'stock_move_extra_products_supply.currency_digits', context=False)
 
     @staticmethod
     def default_quantity():
@@ -52,19 +76,43 @@ class ExtraProductMixin:
             return self.uom.digits
         return 2
 
-    def on_change_with_currency_digits(self, name=None):
+    @classmethod
+    def get_unit_digits(cls, records, name):
+        # The uoms of all the records are read at once
+        return dict((r.id, r.uom.digits if r.uom else 2) for r in records)
+
+    @classmethod
+    def _get_currency_digits(cls):
+        'Return the currency digits of the company in the context'
         Company = Pool().get('company.company')
         company = Transaction().context.get('company')
-        if company:
-            company = Company(company)
-            return company.currency.digits
-        return 2
+        if not company:
+            return 2
+        digits = cls._currency_digits_cache.get(company)
+        if digits is None:
+            digits = Company(company).currency.digits
+            cls._currency_digits_cache.set(company, digits)
+        return digits
+
+    def on_change_with_currency_digits(self, name=None):
+        return self._get_currency_digits()
+
+    @classmethod
+    def get_currency_digits(cls, records, name):
+        digits = cls._get_currency_digits()
+        return dict((r.id, digits) for r in records)
 
     @fields.depends('product')
     def on_change_with_product_uom_category(self, name=None):
         if self.product:
             return self.product.default_uom_category.id
 
+    @classmethod
+    def get_product_uom_category(cls, records, name):
+        # The products of all the records are read at once
+        return dict((r.id, r.product.default_uom_category.id
+                if r.product else None) for r in records)
+
     @fields.depends('product', 'quantity')
     def on_change_product(self):
         if self.product:
@@ -80,20 +128,69 @@ class ExtraProductMixin:
             qty = self.quantity or 1
             self.cost_price = Decimal(str(qty)) * self.product.cost_price
 
+    def _get_copy_values(self):
+        'Return the values to duplicate the extra product'
+        return {
+            'product': self.product.id,
+            'uom': self.uom.id,
+            'quantity': self.quantity,
+            'cost_price': self.cost_price,
+            }
+
+    @classmethod
+    def _get_recompute_cost_price_where(cls, table):
+        'Return the condition of the rows to recompute the cost price'
+        return Literal(True)
+
+    @classmethod
+    def recompute_cost_price(cls, products=None):
+        """Update the cost price of the extra products with the current cost
+        price of their product
+
+        All the products of the extra products are updated if products is
+        None. One UPDATE is executed per product. The cost price of products
+        is the one of the company in the context and the products without
+        cost price are skipped.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        where = cls._get_recompute_cost_price_where(table)
+        if products is None:
+            cursor.execute(*table.select(table.product,
+                    where=where, group_by=table.product))
+            products = Product.browse([r[0] for r in cursor.fetchall()])
+        quantity = Coalesce(NullIf(Cast(table.quantity, 'NUMERIC'), 0), 1)
+        for product in products:
+            if product.cost_price is None:
+                continue
+            cursor.execute(*table.update([table.cost_price],
+                    [quantity * product.cost_price],
+                    where=where & (table.product == product.id)))
+
 
 class MoveExtraProduct(ModelSQL, ModelView, ExtraProductMixin):
     'Stock Move Extra Product'
     __name__ = 'stock.move.extra_product'
     move = fields.Many2One('stock.move', 'Move', required=True,
-        ondelete='CASCADE', states=STATES)
+        select=True, ondelete='CASCADE', states=STATES)
     purchase_request = fields.Many2One('purchase.request', 'Purchase Request',
-        ondelete='SET NULL', readonly=True)
+        select=True, ondelete='SET NULL', readonly=True)
+    purchase_request_dirty = fields.Boolean('Purchase Request Outdated',
+        readonly=True,
+        help="The purchase request must be updated with the changes of the "
+        "extra product or its move.")
+    from_bom = fields.Boolean('From BOM', readonly=True,
+        help="The extra product is set from the BOM of the production and it "
+        "is updated when the production changes.")
     state = fields.Function(fields.Selection([
         ('draft', 'Draft'),
         ('assigned', 'Assigned'),
         ('done', 'Done'),
         ('cancel', 'Canceled'),
-        ], 'State'), 'on_change_with_state')
+        ], 'State'), 'get_state', searcher='search_state')
 
     @classmethod
     def __setup__(cls):
@@ -105,8 +202,111 @@ class MoveExtraProduct(ModelSQL, ModelView, ExtraProductMixin):
         cls.uom.states = STATES
         cls.uom.depends.append('move')
 
-    def get_purchase_request(self):
-        'Return purchase request for the extra product'
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        fill_from_bom = (TableHandler.table_exist(cls._table)
+            and not TableHandler(cls, module_name).column_exist('from_bom'))
+
+        super(MoveExtraProduct, cls).__register__(module_name)
+
+        # Migration from 4.0: flag the extra products set from the BOM
+        if fill_from_bom:
+            cls._migrate_from_bom()
+
+    @classmethod
+    def _migrate_from_bom(cls):
+        'Flag the extra products of a BOM line of the production of their move'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        for move_field, line_name, line_field in [
+                ('production_input', 'production.bom.input', 'bom_input'),
+                ('production_output', 'production.bom.output', 'bom_output'),
+                ]:
+            move = Move.__table__()
+            production = Production.__table__()
+            line = pool.get(line_name).__table__()
+            line_extra = pool.get(line_name + '.extra_product').__table__()
+            # Only the extra products of the BOM itself are found, not the
+            # ones rolled up from the BOMs of the inputs
+            query = move.join(production,
+                condition=getattr(move, move_field) == production.id
+                ).join(line,
+                condition=(line.bom == production.bom)
+                & (line.product == move.product)
+                ).join(line_extra,
+                condition=getattr(line_extra, line_field) == line.id
+                ).select(Literal(1),
+                where=(move.id == table.move)
+                & (line_extra.product == table.product)
+                & (line_extra.uom == table.uom))
+            cursor.execute(*table.update([table.from_bom], [True],
+                    where=Exists(query)))
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        records = super(MoveExtraProduct, cls).create(vlist)
+        Move.update_extra_products_cost(list(set(r.move for r in records)))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        moves = set()
+        args = list(args)
+        actions = iter(args)
+        for i, (records, values) in enumerate(zip(actions, actions)):
+            if 'cost_price' in values or 'move' in values:
+                moves.update(r.move for r in records)
+                if values.get('move'):
+                    moves.add(Move(values['move']))
+            if set(values) & cls._purchase_request_fields():
+                args[i * 2 + 1] = dict(values, purchase_request_dirty=True)
+        super(MoveExtraProduct, cls).write(*args)
+        Move.update_extra_products_cost(list(moves))
+
+    @staticmethod
+    def default_purchase_request_dirty():
+        return False
+
+    @staticmethod
+    def default_from_bom():
+        return False
+
+    def _get_copy_values(self):
+        values = super(MoveExtraProduct, self)._get_copy_values()
+        values['from_bom'] = self.from_bom
+        return values
+
+    @staticmethod
+    def _purchase_request_fields():
+        'Return the fields that change the purchase request'
+        return {'product', 'uom', 'quantity', 'move'}
+
+    @classmethod
+    def delete(cls, records):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        moves = list(set(r.move for r in records))
+        super(MoveExtraProduct, cls).delete(records)
+        Move.update_extra_products_cost(moves)
+
+    def get_purchase_request(self, cache=None, supplier_measure=None,
+            uom_measure=None):
+        """Return purchase request for the extra product
+
+        cache is an optional dictionary shared by the extra products
+        processed in the same batch to reuse the supplier and unit of measure
+        lookups, which are measured by the optional MeasureAccumulator
+        supplier_measure and uom_measure.
+        """
         pool = Pool()
         Uom = pool.get('product.uom')
         Request = pool.get('purchase.request')
@@ -116,11 +316,22 @@ class MoveExtraProduct(ModelSQL, ModelView, ExtraProductMixin):
                 self.purchase_request.state in ['purchased', 'done']):
             return
 
+        if cache is None:
+            cache = {}
         date = self.move.planned_date or Date.today()
         product = self.product
-        supplier, purchase_date = Request.find_best_supplier(product, date)
+        company = self.move.company
+        key = ('supplier', product.id, date, company.id if company else None)
+        if key not in cache:
+            with accumulate(supplier_measure):
+                cache[key] = Request.find_best_supplier(product, date)
+        supplier, purchase_date = cache[key]
         uom = product.purchase_uom or product.default_uom
-        quantity = Uom.compute_qty(self.uom, self.quantity, uom)
+        key = ('uom', self.uom.id, uom.id)
+        if key not in cache:
+            with accumulate(uom_measure):
+                cache[key] = Uom.compute_qty(self.uom, 1, uom, round=False)
+        quantity = Uom.round(self.quantity * cache[key], uom.rounding)
         with Transaction().set_user(0, set_context=True):
             if (self.purchase_request and
                     self.purchase_request.state == 'draft'):
@@ -142,12 +353,586 @@ class MoveExtraProduct(ModelSQL, ModelView, ExtraProductMixin):
 
         return request
 
+    @classmethod
+    def create_purchase_requests(cls, records):
+        """Create or update the purchase requests of the extra products and
+        return those skipped because another transaction is processing them"""
+        pool = Pool()
+        Request = pool.get('purchase.request')
+        Configuration = pool.get('stock.configuration')
+
+        # Grouped requests must keep the sum of all their extra products
+        records = cls._get_purchase_request_siblings(records)
+        records, skipped = cls._lock_purchase_requests(records)
+        extras, requests, fingerprints = [], [], {}
+        cache = {}
+        supplier_measure = MeasureAccumulator(
+            'purchase.request.find_best_supplier')
+        uom_measure = MeasureAccumulator('product.uom.compute_qty')
+        with measure('stock.move.extra_product.get_purchase_request',
+                len(records)):
+            for extra in records:
+                fingerprint = None
+                if extra.purchase_request:
+                    fingerprint = cls._get_request_fingerprint(
+                        extra.purchase_request)
+                request = extra.get_purchase_request(cache=cache,
+                    supplier_measure=supplier_measure,
+                    uom_measure=uom_measure)
+                if not request:
+                    continue
+                extras.append(extra)
+                requests.append(request)
+                fingerprints[id(request)] = fingerprint
+        supplier_measure.report()
+        uom_measure.report()
+        if not requests:
+            return skipped
+        requests = cls._group_purchase_requests(requests,
+            group=Configuration(1).extra_products_group_requests)
+        # Do not save the existing requests whose values do not change
+        to_save = [r for r in dict((id(r), r) for r in requests).values()
+            if (r.id is None
+                or cls._get_request_fingerprint(r) != fingerprints[id(r)])]
+        with measure('purchase.request.save', len(to_save)):
+            Request.save(to_save)
+
+        to_link, unlinked_ids = {}, set()
+        for extra, request in zip(extras, requests):
+            if extra.purchase_request != request:
+                to_link.setdefault(request.id, []).append(extra)
+                if extra.purchase_request:
+                    unlinked_ids.add(extra.purchase_request.id)
+        to_write = []
+        for request_id, request_extras in to_link.items():
+            to_write.extend((request_extras, {
+                        'purchase_request': request_id,
+                        }))
+        if to_write:
+            with measure('stock.move.extra_product.write', len(to_write) // 2):
+                cls.write(*to_write)
+        # The requests left by the extra products may be no longer used
+        if unlinked_ids:
+            cls._delete_unused_purchase_requests(unlinked_ids)
+        return skipped
+
+    @classmethod
+    def _delete_unused_purchase_requests(cls, request_ids):
+        'Delete the draft requests of request_ids without extra products'
+        pool = Pool()
+        Request = pool.get('purchase.request')
+        request_ids = set(request_ids)
+        used_ids = set(r.purchase_request.id for r in cls.search([
+                    ('purchase_request', 'in', list(request_ids)),
+                    ]))
+        requests = [r for r in Request.browse(list(request_ids - used_ids))
+            if r.state == 'draft']
+        if requests:
+            with measure('purchase.request.delete', len(requests)):
+                Request.delete(requests)
+
+    @classmethod
+    def _get_purchase_request_siblings(cls, records):
+        'Return the records and the extra products of their draft requests'
+        request_ids = list(set(r.purchase_request.id for r in records
+                if r.purchase_request and r.purchase_request.state == 'draft'))
+        if not request_ids:
+            return records
+        ids = set(r.id for r in records)
+        siblings = [e for e in cls.search([
+                    ('purchase_request', 'in', request_ids),
+                    ], order=[('move', 'ASC'), ('id', 'ASC')])
+            if e.id not in ids]
+        return list(records) + siblings
+
+    @classmethod
+    def _lock_purchase_requests(cls, records):
+        """Return the locked records and the skipped ones, those processed by
+        another transaction and those sharing a draft request with them"""
+        if backend.name() != 'postgresql' or not records:
+            return records, []
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = set()
+        for sub_ids in grouped_slice([r.id for r in records]):
+            # The transaction creating the requests of an extra product holds
+            # its advisory lock until the end, so it is taken without waiting.
+            # Then the row lock without waiting fails also for the rows
+            # changed by a transaction committed after the snapshot of this one
+            cursor.execute(*table.select(table.id,
+                    TryAdvisoryXactLock(PURCHASE_REQUEST_LOCK, table.id),
+                    where=reduce_ids(table.id, sub_ids)))
+            locked_ids = [id_ for id_, locked in cursor.fetchall() if locked]
+            if not cls._lock_rows(locked_ids):
+                # Find the conflicting rows one by one
+                locked_ids = [i for i in locked_ids if cls._lock_rows([i])]
+            ids.update(locked_ids)
+        skipped_request_ids = set(r.purchase_request.id for r in records
+            if r.id not in ids and r.purchase_request)
+        # The extra products sharing a draft request with a skipped one are
+        # skipped too as their sum can not be computed
+        locked, skipped = [], []
+        for record in records:
+            if (record.id in ids
+                    and not (record.purchase_request
+                        and record.purchase_request.id in skipped_request_ids)):
+                locked.append(record.id)
+            else:
+                skipped.append(record.id)
+        # Browse again to read the current purchase request of the locked rows
+        return cls.browse(locked), cls.browse(skipped)
+
+    @classmethod
+    def _lock_rows(cls, ids):
+        'Lock the rows of ids without waiting and return if it succeeded'
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        if not ids:
+            return True
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        query, params = tuple(table.select(table.id,
+                where=reduce_ids(table.id, ids)))
+        # A failed statement aborts the transaction unless it is rolled back
+        # to a savepoint
+        cursor.execute('SAVEPOINT stock_move_extra_product_lock')
+        try:
+            cursor.execute(query + ' FOR UPDATE NOWAIT', params)
+        except DatabaseOperationalError:
+            cursor.execute('ROLLBACK TO SAVEPOINT '
+                'stock_move_extra_product_lock')
+            return False
+        cursor.execute('RELEASE SAVEPOINT stock_move_extra_product_lock')
+        return True
+
+    @staticmethod
+    def _get_request_fingerprint(request):
+        'Return the values that identify the content of the request'
+        return (request.product, request.party, request.quantity, request.uom,
+            request.purchase_date, request.supply_date, request.company,
+            request.warehouse)
+
+    @staticmethod
+    def _get_request_grouping_key(request):
+        'Return the key to group the purchase requests of extra products'
+        return (request.product, request.party, request.warehouse,
+            request.company, request.supply_date, request.uom)
+
+    @classmethod
+    def _group_purchase_requests(cls, requests, group=True):
+        """Return the requests replaced by the request of their group with the
+        sum of the quantities, each request is its own group if not group"""
+        keys, groups = [], {}
+        for i, request in enumerate(requests):
+            if group:
+                key = cls._get_request_grouping_key(request)
+            else:
+                key = i
+            if key not in groups:
+                keys.append(key)
+            groups.setdefault(key, []).append(request)
+        # An existing request stays with the group having most of its members,
+        # the other groups get another request or a new one
+        owners, counts = {}, {}
+        for key in keys:
+            for request in groups[key]:
+                if request.id is None:
+                    continue
+                count = counts[(key, request.id)] = (
+                    counts.get((key, request.id), 0) + 1)
+                if count > counts.get((owners.get(request.id), request.id), 0):
+                    owners[request.id] = key
+        grouped = {}
+        for key in keys:
+            members = groups[key]
+            for request in members:
+                if request.id is not None and owners[request.id] == key:
+                    break
+            else:
+                for request in members:
+                    if request.id is None:
+                        break
+                else:
+                    request = cls._copy_purchase_request(members[0])
+            quantity = sum(r.quantity for r in members)
+            request.quantity = quantity
+            request.computed_quantity = quantity
+            for other in members:
+                grouped[id(other)] = request
+        return [grouped[id(r)] for r in requests]
+
+    @staticmethod
+    def _copy_purchase_request(request):
+        'Return a new purchase request with the values of request'
+        Request = Pool().get('purchase.request')
+        with Transaction().set_user(0, set_context=True):
+            new_request = Request()
+        for name in ['product', 'party', 'quantity', 'uom',
+                'computed_quantity', 'computed_uom', 'purchase_date',
+                'supply_date', 'company', 'origin', 'warehouse']:
+            setattr(new_request, name, getattr(request, name))
+        return new_request
+
+    @classmethod
+    def resync_purchase_requests(cls):
+        """Update the draft purchase requests of the outdated extra products
+
+        The extra products sharing a request with an outdated one are
+        recomputed too by create_purchase_requests.
+        """
+        records = cls.search([
+                ('purchase_request_dirty', '=', True),
+                ], order=[('move', 'ASC'), ('id', 'ASC')])
+        if not records:
+            return
+        extras = [r for r in records if r.purchase_request]
+        with measure('stock.move.extra_product.resync', len(extras)):
+            skipped = cls.create_purchase_requests(extras)
+        # The skipped extra products stay outdated for the next run
+        skipped_ids = set(r.id for r in skipped)
+        records = [r for r in records if r.id not in skipped_ids]
+        if records:
+            cls.write(records, {
+                    'purchase_request_dirty': False,
+                    })
+
+    @classmethod
+    def _get_missing_purchase_request_query(cls, after_id=0, last_id=None,
+            limit=None):
+        """Return the query of the ids of the extra products of assigned or
+        done moves without purchase request, ordered by id"""
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        extra = cls.__table__()
+        move = Move.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+
+        where = ((extra.purchase_request == Null)
+            & (extra.id > after_id)
+            & ((move.state.in_(['assigned', 'done'])
+                    & (from_location.type == 'storage')
+                    & to_location.type.in_(['storage', 'production']))
+                | ((move.state == 'done')
+                    & from_location.type.in_(['supplier', 'production'])
+                    & (to_location.type == 'storage'))))
+        if last_id is not None:
+            where &= extra.id <= last_id
+        return extra.join(move, condition=extra.move == move.id
+            ).join(from_location,
+            condition=move.from_location == from_location.id
+            ).join(to_location,
+            condition=move.to_location == to_location.id
+            ).select(extra.id,
+            where=where,
+            order_by=extra.id.asc,
+            limit=limit)
+
+    @classmethod
+    def backfill_purchase_requests(cls, first_id, last_id):
+        """Create the missing purchase requests of the extra products of
+        assigned or done moves with id between first_id and last_id
+
+        Return the number of extra products processed.
+        """
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*cls._get_missing_purchase_request_query(
+                after_id=first_id - 1, last_id=last_id))
+        records = cls.browse([r[0] for r in cursor.fetchall()])
+        skipped = cls.create_purchase_requests(records)
+        return len(records) - len(skipped)
+
+    @classmethod
+    def _get_export_query(cls, from_date=None, to_date=None, warehouse=None,
+            company=None):
+        """Return the query of the extra products with their move, product,
+        cost and purchase request status"""
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        Request = pool.get('purchase.request')
+        PurchaseLine = pool.get('purchase.line')
+        Purchase = pool.get('purchase.purchase')
+        extra = cls.__table__()
+        move = Move.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+        product = Product.__table__()
+        request = Request.__table__()
+        line = PurchaseLine.__table__()
+        purchase = Purchase.__table__()
+
+        date = Coalesce(move.effective_date, move.planned_date)
+        where = Literal(True)
+        if from_date:
+            where &= date >= from_date
+        if to_date:
+            where &= date <= to_date
+        if warehouse:
+            where &= (((from_location.left >= warehouse.left)
+                    & (from_location.right <= warehouse.right))
+                | ((to_location.left >= warehouse.left)
+                    & (to_location.right <= warehouse.right)))
+        if company:
+            where &= move.company == company.id
+        # Same as the state of the purchase request which is not stored
+        request_state = Case(
+            (request.id == Null, Null),
+            (request.purchase_line == Null, 'draft'),
+            (purchase.state == 'cancel', 'cancel'),
+            (purchase.state == 'done', 'done'),
+            else_='purchased')
+        return extra.join(move, condition=extra.move == move.id
+            ).join(from_location,
+            condition=move.from_location == from_location.id
+            ).join(to_location,
+            condition=move.to_location == to_location.id
+            ).join(product, condition=extra.product == product.id
+            ).join(request, 'LEFT',
+            condition=extra.purchase_request == request.id
+            ).join(line, 'LEFT', condition=request.purchase_line == line.id
+            ).join(purchase, 'LEFT', condition=line.purchase == purchase.id
+            ).select(
+            extra.id.as_('id'),
+            move.id.as_('move'),
+            move.shipment.as_('shipment'),
+            move.state.as_('move_state'),
+            date.as_('date'),
+            product.code.as_('product_code'),
+            extra.product.as_('product'),
+            extra.quantity.as_('quantity'),
+            extra.uom.as_('uom'),
+            extra.cost_price.as_('cost_price'),
+            extra.purchase_request.as_('purchase_request'),
+            request_state.as_('purchase_request_state'),
+            request.purchase_line.as_('purchase_line'),
+            line.purchase.as_('purchase'),
+            purchase.state.as_('purchase_state'),
+            where=where,
+            order_by=extra.id.asc)
+
+    @classmethod
+    def export_rows(cls, from_date=None, to_date=None, warehouse=None,
+            company=None, size=1000):
+        """Yield a dictionary per extra product of the export query
+
+        A server-side cursor is used on PostgreSQL so the rows are fetched by
+        batches of size and the memory usage does not depend on the number of
+        rows.
+        """
+        connection = Transaction().connection
+        if backend.name() == 'postgresql':
+            cursor = connection.cursor('stock_move_extra_product_export')
+        else:
+            cursor = connection.cursor()
+        cursor.execute(*cls._get_export_query(from_date=from_date,
+                to_date=to_date, warehouse=warehouse, company=company))
+        columns = None
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            if columns is None:
+                columns = [d[0] for d in cursor.description]
+            for row in rows:
+                yield dict(zip(columns, row))
+        cursor.close()
+
+    @classmethod
+    def _get_recompute_cost_price_where(cls, table):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        # The cost price of the products is the one of the company
+        company = Transaction().context.get('company')
+        if company:
+            move_where = move.company == company
+        else:
+            move_where = Literal(False)
+        move_where &= ~move.state.in_(['done', 'cancel'])
+        return (super(MoveExtraProduct, cls)._get_recompute_cost_price_where(
+                table)
+            & table.move.in_(move.select(move.id, where=move_where)))
+
+    @classmethod
+    def recompute_cost_price(cls, products=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        where = cls._get_recompute_cost_price_where(table)
+        if products is not None:
+            where &= reduce_ids(table.product, [p.id for p in products])
+        cursor.execute(*table.select(table.move, where=where,
+                group_by=table.move))
+        moves = Move.browse([r[0] for r in cursor.fetchall()])
+        super(MoveExtraProduct, cls).recompute_cost_price(products)
+        Move.update_extra_products_cost(moves)
+
     @fields.depends('move')
     def on_change_with_state(self, name=None):
         if self.move:
             return self.move.state
         return None
 
+    @classmethod
+    def get_state(cls, records, name):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        table = cls.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        states = dict.fromkeys([r.id for r in records])
+        for sub_ids in grouped_slice(states.keys()):
+            cursor.execute(*table.join(move,
+                    condition=table.move == move.id
+                    ).select(table.id, move.state,
+                    where=reduce_ids(table.id, sub_ids)))
+            states.update(cursor.fetchall())
+        return states
+
+    @classmethod
+    def search_state(cls, name, clause):
+        return [('move.state',) + tuple(clause[1:])]
+
+
+class MoveExtraProductQueue(ModelSQL, ModelView):
+    'Stock Move Extra Product Queue'
+    __name__ = 'stock.move.extra_product.queue'
+    move = fields.Many2One('stock.move', 'Move', required=True, select=True,
+        ondelete='CASCADE', readonly=True)
+    state = fields.Selection([
+            ('waiting', 'Waiting'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, select=True, readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    max_attempts = 5
+
+    @classmethod
+    def __setup__(cls):
+        super(MoveExtraProductQueue, cls).__setup__()
+        cls._order.insert(0, ('id', 'ASC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'waiting'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def enqueue(cls, moves):
+        'Queue the moves to create the purchase requests of extra products'
+        waiting = set(q.move.id for q in cls.search([
+                    ('move', 'in', [m.id for m in moves]),
+                    ('state', '=', 'waiting'),
+                    ]))
+        cls.create([{'move': m.id} for m in moves if m.id not in waiting])
+
+    @classmethod
+    def _lock_waiting(cls, last_id, batch_size):
+        """Return the (id, move) of the next waiting queue rows after last_id
+        locking them
+
+        Rows locked by other workers are skipped.
+        """
+        queue = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        query, params = tuple(queue.select(queue.id, queue.move,
+                where=(queue.state == 'waiting') & (queue.id > last_id),
+                order_by=queue.id.asc,
+                limit=batch_size))
+        if backend.name() == 'postgresql':
+            query += ' FOR UPDATE SKIP LOCKED'
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+    @classmethod
+    def process(cls, batch_size=100):
+        'Create the purchase requests of the queued moves by batch'
+        last_id = 0
+        while True:
+            # Each batch is committed in its own transaction so several
+            # workers can run in parallel
+            with Transaction().new_transaction() as transaction:
+                rows = cls._lock_waiting(last_id, batch_size)
+                if not rows:
+                    break
+                queue_ids = [r[0] for r in rows]
+                last_id = max(queue_ids)
+                try:
+                    cls._process(rows)
+                    transaction.commit()
+                except Exception:
+                    transaction.rollback()
+                    logger.exception('Fail to create purchase requests of '
+                        'extra products for moves %s', [r[1] for r in rows])
+                    # Retried on the next run until max_attempts
+                    cls._fail(queue_ids)
+
+    @classmethod
+    def _process(cls, rows):
+        """Create the purchase requests of the moves of the (id, move) queue
+        rows and delete the rows except those of moves with skipped extra
+        products"""
+        Move = Pool().get('stock.move')
+        moves = Move.browse(list(set(r[1] for r in rows)))
+        skipped = Move.create_extra_purchase_requests([m for m in moves
+                if m.state in ('assigned', 'done')])
+        skipped_move_ids = set(e.move.id for e in skipped)
+        cls.delete(cls.browse([i for i, move_id in rows
+                    if move_id not in skipped_move_ids]))
+
+    @classmethod
+    def _fail(cls, queue_ids):
+        'Increase the attempts of the queue rows in a new transaction'
+        with Transaction().new_transaction() as transaction:
+            cls.increase_attempts(cls.browse(queue_ids))
+            transaction.commit()
+
+    @classmethod
+    def increase_attempts(cls, records):
+        'Increase the attempts of the records and fail them at max_attempts'
+        to_write = []
+        failed = []
+        for record in records:
+            attempts = record.attempts + 1
+            if attempts >= cls.max_attempts:
+                failed.append(record)
+            to_write.extend(([record], {
+                        'attempts': attempts,
+                        'state': ('failed'
+                            if attempts >= cls.max_attempts
+                            else 'waiting'),
+                        }))
+        if to_write:
+            cls.write(*to_write)
+        if failed:
+            logger.warning('Fail to create purchase requests of extra '
+                'products for moves %s after %s attempts',
+                [r.move.id for r in failed], cls.max_attempts)
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, records):
+        'Put the failed records back in the queue'
+        failed = [r for r in records if r.state == 'failed']
+        if failed:
+            cls.write(failed, {
+                    'state': 'waiting',
+                    'attempts': 0,
+                    })
+
 
 class Move:
     __metaclass__ = PoolMeta
@@ -159,38 +944,190 @@ class Move:
             'readonly': In(Eval('state'), ['cancel', 'assigned', 'done']),
         },
         depends=['state'])
+    extra_products_cost = fields.Numeric('Extra Products Cost',
+        digits=price_digits, readonly=True,
+        help="The sum of the cost price of the extra products.")
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        table = TableHandler(cls, module_name)
+        fill_cost = not table.column_exist('extra_products_cost')
+
+        super(Move, cls).__register__(module_name)
+
+        # Migration from 4.0: store extra products cost
+        if fill_cost:
+            cls.update_extra_products_cost()
+
+    @classmethod
+    def update_extra_products_cost(cls, moves=None):
+        """Store the cost of the extra products of the moves
+
+        All the moves are updated if moves is None.
+        """
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+        move = cls.__table__()
+        extra = ExtraProduct.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cost = extra.select(Sum(extra.cost_price),
+            where=extra.move == move.id)
+        if moves is None:
+            cursor.execute(*move.update([move.extra_products_cost], [cost]))
+            return
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            cursor.execute(*move.update([move.extra_products_cost], [cost],
+                    where=reduce_ids(move.id, sub_ids)))
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+        extra = ExtraProduct.__table__()
+        cursor = Transaction().connection.cursor()
+
+        moves = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if set(values) & cls._extra_purchase_request_fields():
+                moves.extend(records)
+        super(Move, cls).write(*args)
+
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            cursor.execute(*extra.update([extra.purchase_request_dirty],
+                    [True],
+                    where=reduce_ids(extra.move, sub_ids)
+                    & (extra.purchase_request != Null)))
+
+    @staticmethod
+    def _extra_purchase_request_fields():
+        'Return the fields of the move that change the extra products requests'
+        return {'planned_date', 'company', 'from_location', 'to_location'}
+
+    @classmethod
+    def copy(cls, moves, default=None):
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+        if default is None:
+            default = {}
+        default = default.copy()
+        # The cost is stored again from the extra products of the copies
+        default.setdefault('extra_products_cost', None)
+        if 'extra_products' in default:
+            new_moves = super(Move, cls).copy(moves, default=default)
+            cls.update_extra_products_cost(new_moves)
+            return new_moves
+
+        # Copy the extra products of all the moves at once
+        default['extra_products'] = []
+        new_moves = super(Move, cls).copy(moves, default=default)
+        new_ids = dict((m.id, n.id) for m, n in zip(moves, new_moves))
+        to_create = []
+        for extra in ExtraProduct.search([
+                    ('move', 'in', list(new_ids.keys())),
+                    ], order=[('id', 'ASC')]):
+            values = extra._get_copy_values()
+            values['move'] = new_ids[extra.move.id]
+            to_create.append(values)
+        if to_create:
+            ExtraProduct.create(to_create)
+        return new_moves
 
     def create_purchase_requests(self):
         'Create the purchase requests for the extra products'
-        try:
-            super(Move, self).create_purchase_requests()
-        except AttributeError:
-            pass
-        for extra in self.extra_products:
-            request = extra.get_purchase_request()
-            if not request:
-                continue
-            request.save()
-            extra.purchase_request = request
-            extra.save()
+        self._enqueue_skipped_extra_products(
+            self.create_extra_purchase_requests([self]))
+
+    @classmethod
+    def create_extra_purchase_requests(cls, moves):
+        """Create the purchase requests for the extra products of moves
+
+        Return the extra products skipped because another transaction is
+        processing them.
+        """
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+
+        for move in moves:
+            try:
+                super(Move, move).create_purchase_requests()
+            except AttributeError:
+                pass
+
+        # Search all the extra products at once so their moves, locations and
+        # products are read in bulk instead of once per move
+        with measure('stock.move.extra_product.search', len(moves)):
+            extras = ExtraProduct.search([
+                    ('move', 'in', [m.id for m in moves]),
+                    ], order=[('move', 'ASC'), ('id', 'ASC')])
+        return ExtraProduct.create_purchase_requests(extras)
+
+    @staticmethod
+    def _enqueue_skipped_extra_products(extras):
+        'Queue the moves of the skipped extra products to process them later'
+        Queue = Pool().get('stock.move.extra_product.queue')
+        if extras:
+            Queue.enqueue(list(set(e.move for e in extras)))
+
+    @classmethod
+    def _get_extra_products_moves(cls, moves, from_types, to_types):
+        """Return the moves with extra products between locations of the
+        types from_types and to_types"""
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+        Location = pool.get('stock.location')
+        move = cls.__table__()
+        extra = ExtraProduct.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+        cursor = Transaction().connection.cursor()
+
+        move_ids = set()
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            cursor.execute(*move.join(from_location,
+                    condition=move.from_location == from_location.id
+                    ).join(to_location,
+                    condition=move.to_location == to_location.id
+                    ).join(extra, condition=extra.move == move.id
+                    ).select(move.id,
+                    where=(reduce_ids(move.id, sub_ids)
+                        & from_location.type.in_(from_types)
+                        & to_location.type.in_(to_types)),
+                    group_by=move.id))
+            move_ids.update(r[0] for r in cursor.fetchall())
+        return cls.browse([m.id for m in moves if m.id in move_ids])
+
+    @classmethod
+    def _supply_extra_products(cls, moves):
+        """Create the purchase requests for the extra products of moves or
+        queue them if it is configured"""
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        Queue = pool.get('stock.move.extra_product.queue')
+        if not moves:
+            return
+        if Configuration(1).extra_products_async_requests:
+            Queue.enqueue(moves)
+        else:
+            cls._enqueue_skipped_extra_products(
+                cls.create_extra_purchase_requests(moves))
 
     @classmethod
     def assign(cls, moves):
         'Create the purchase requests for extra products of moves '
         'when assing out and internal shipments'
-        super(Move, cls).assign(moves)
-        for move in moves:
-            if (move.extra_products
-                    and move.from_location.type == 'storage'
-                    and move.to_location.type in ('storage', 'production')):
-                move.create_purchase_requests()
+        with measure('stock.move.assign', len(moves)):
+            super(Move, cls).assign(moves)
+            cls._supply_extra_products(cls._get_extra_products_moves(
+                    moves, ['storage'], ['storage', 'production']))
 
     @classmethod
     def do(cls, moves):
         'Create the purchase requests for extra products of moves '
         'when receiving in shipments'
-        super(Move, cls).do(moves)
-        for move in moves:
-            if (move.from_location.type in ('supplier', 'production')
-                    and move.to_location.type == 'storage'):
-                move.create_purchase_requests()
+        with measure('stock.move.do', len(moves)):
+            super(Move, cls).do(moves)
+            cls._supply_extra_products(cls._get_extra_products_moves(
+                    moves, ['supplier', 'production'], ['storage']))
@@ -2,12 +2,18 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from decimal import Decimal
+from sql import Null
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
 from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.modules.product import price_digits
+from .bom import scale_extra_values
+from .instrument import measure
 
 __all__ = ['Production', 'AddExtraProductBOMStart', 'AddExtraProductBOM']
 
@@ -16,7 +22,8 @@ class Production:
     __metaclass__ = PoolMeta
     __name__ = "production"
     extra_products_cost = fields.Function(fields.Numeric('Extra Product Cost',
-        digits=price_digits), 'on_change_with_extra_products_cost')
+        digits=price_digits), 'get_extra_products_cost',
+        searcher='search_extra_products_cost')
     total_cost = fields.Function(fields.Numeric('Total Cost',
         digits=price_digits), 'on_change_with_total_cost')
 
@@ -28,12 +35,186 @@ class Production:
                 ep_cost += ep.cost_price if ep.cost_price else Decimal('0')
         return ep_cost
 
+    @classmethod
+    def _get_extra_products_cost_query(cls, production_ids=None):
+        """Return the query with the columns production and cost summing the
+        extra products cost of inputs and outputs
+
+        The query is limited to production_ids if it is not None.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+
+        production = Coalesce(move.production_input, move.production_output)
+        if production_ids is None:
+            where = production != Null
+        else:
+            where = (reduce_ids(move.production_input, production_ids)
+                | reduce_ids(move.production_output, production_ids))
+        return move.select(production.as_('production'),
+            Sum(move.extra_products_cost).as_('cost'),
+            where=where,
+            group_by=production)
+
+    @classmethod
+    def get_extra_products_cost(cls, productions, name):
+        cursor = Transaction().connection.cursor()
+
+        costs = dict((p.id, Decimal('0')) for p in productions)
+        for sub_ids in grouped_slice(costs.keys()):
+            cursor.execute(*cls._get_extra_products_cost_query(sub_ids))
+            for production_id, cost in cursor.fetchall():
+                if cost is not None:
+                    costs[production_id] = Decimal(str(cost))
+        return costs
+
+    @classmethod
+    def search_extra_products_cost(cls, name, clause):
+        table = cls.__table__()
+        query = cls._get_extra_products_cost_query()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        value = cls.extra_products_cost.sql_format(value)
+        return [('id', 'in', table.join(query, 'LEFT',
+                    condition=query.production == table.id
+                    ).select(table.id,
+                    where=Operator(Coalesce(query.cost, 0), value)))]
+
+    @classmethod
+    def order_extra_products_cost(cls, tables):
+        table, _ = tables[None]
+        if 'extra_products_cost' not in tables:
+            query = cls._get_extra_products_cost_query()
+            tables['extra_products_cost'] = {
+                None: (query, query.production == table.id),
+                }
+        query, _ = tables['extra_products_cost'][None]
+        return [Coalesce(query.cost, 0)]
+
     @fields.depends('cost', 'extra_products_cost', 'timesheet_cost')
     def on_change_with_total_cost(self, name=None):
         # If production_timesheet is installed the timesheet cost must be added
         ts_cost = self.timesheet_cost if self.timesheet_cost else Decimal('0')
         return self.cost + self.extra_products_cost + ts_cost
 
+    @classmethod
+    def create(cls, vlist):
+        productions = super(Production, cls).create(vlist)
+        if cls._extra_products_from_bom():
+            cls.sync_extra_products_from_bom(productions)
+        return productions
+
+    @classmethod
+    def write(cls, *args):
+        super(Production, cls).write(*args)
+        if not cls._extra_products_from_bom():
+            return
+        productions = set()
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if set(values) & {'bom', 'quantity', 'uom'}:
+                productions.update(records)
+        cls.sync_extra_products_from_bom(list(productions))
+
+    @staticmethod
+    def _extra_products_from_bom():
+        'Return if the BOM extra products are added automatically'
+        Configuration = Pool().get('stock.configuration')
+        return Configuration(1).extra_products_from_bom
+
+    def _get_extra_products_factor(self):
+        'Return the factor to scale the BOM extra products'
+        if not (self.bom and self.product and self.uom):
+            return 0
+        return self.bom.compute_factor(self.product, self.quantity or 0,
+            self.uom)
+
+    @staticmethod
+    def _scale_bom_extra_products(extra_products, factor):
+        'Return the extra product values scaled by factor and rounded'
+        Uom = Pool().get('product.uom')
+        result = []
+        for values in extra_products:
+            values = scale_extra_values(values, factor)
+            values['quantity'] = Uom.round(values['quantity'],
+                Uom(values['uom']).rounding)
+            result.append(values)
+        return result
+
+    def set_moves(self):
+        super(Production, self).set_moves()
+        if self._extra_products_from_bom():
+            self.sync_extra_products_from_bom([self])
+
+    @classmethod
+    def add_extra_products_from_bom(cls, productions):
+        """Set the extra products of inputs and outputs from the BOM ones
+
+        They are scaled to the production quantity when the BOM extra products
+        are added automatically.
+        """
+        cls.sync_extra_products_from_bom(productions,
+            scale=cls._extra_products_from_bom())
+
+    @classmethod
+    def sync_extra_products_from_bom(cls, productions, scale=True):
+        """Update the extra products of inputs and outputs from the BOM
+
+        The extra products are scaled to the production quantity if scale.
+        Only the differences are written: the existing extra products from the
+        BOM with the same product and unit are updated and the others are
+        created or deleted. The extra products added by hand are kept.
+        """
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+
+        memo = {}
+        to_delete, to_create, to_write = [], [], []
+        for production in productions:
+            if not production.bom:
+                continue
+            if (scale
+                    and production.state not in ['request', 'draft',
+                        'waiting']):
+                continue
+            extra_products = production.bom.explode_extra_products(memo)
+            factor = production._get_extra_products_factor() if scale else 1
+            for type_, moves in (('input', production.inputs),
+                    ('output', production.outputs)):
+                for move in moves:
+                    existing = {}
+                    for extra in move.extra_products:
+                        if not extra.from_bom:
+                            continue
+                        key = (extra.product.id, extra.uom.id)
+                        if key in existing:
+                            to_delete.append(extra)
+                        else:
+                            existing[key] = extra
+                    for values in cls._scale_bom_extra_products(
+                            extra_products.get((type_, move.product.id), []),
+                            factor):
+                        extra = existing.pop(
+                            (values['product'], values['uom']), None)
+                        if not extra:
+                            values['move'] = move.id
+                            values['from_bom'] = True
+                            to_create.append(values)
+                        elif (extra.quantity != values['quantity']
+                                or extra.cost_price != values['cost_price']):
+                            to_write.extend(([extra], {
+                                        'quantity': values['quantity'],
+                                        'cost_price': values['cost_price'],
+                                        }))
+                    to_delete.extend(existing.values())
+        if to_delete:
+            ExtraProduct.delete(to_delete)
+        if to_write:
+            ExtraProduct.write(*to_write)
+        if to_create:
+            ExtraProduct.create(to_create)
+
 
 class AddExtraProductBOMStart(ModelView):
     'Add extra products to inputs/outputs from BOM'
@@ -52,55 +233,11 @@ class AddExtraProductBOM(Wizard):
     add_ = StateTransition()
 
     def transition_add_(self):
-        pool = Pool()
-        Production = pool.get('production')
-        BOMInput = pool.get('production.bom.input')
-        BOMOutput = pool.get('production.bom.output')
-        Move = pool.get('stock.move')
+        Production = Pool().get('production')
 
         context = Transaction().context
-        production = Production(context['active_id'])
-        if not production.bom:
-            return 'end'
-        bom = production.bom
-
-        for move in production.inputs:
-            create = []
-            bom_inputs = BOMInput.search([
-                    ('bom', '=', bom.id),
-                    ('product', '=', move.product.id),
-                    ], limit=1)
-            if bom_inputs:
-                for extra_product in bom_inputs[0].extra_products:
-                    create.append({
-                        'move': move.id,
-                        'product': extra_product.product.id,
-                        'quantity': extra_product.quantity,
-                        'uom': extra_product.uom.id,
-                        'cost_price': extra_product.cost_price,
-                    })
-            data = [('remove', [ep.id for ep in move.extra_products])]
-            if create:
-                data.append(('create', create))
-            Move.write([move], {'extra_products': data})
-
-        for move in production.outputs:
-            create = []
-            bom_outputs = BOMOutput.search([
-                    ('bom', '=', bom.id),
-                    ('product', '=', move.product.id),
-                    ], limit=1)
-            if bom_outputs:
-                for extra_product in bom_outputs[0].extra_products:
-                    create.append({
-                        'move': move.id,
-                        'product': extra_product.product.id,
-                        'quantity': extra_product.quantity,
-                        'uom': extra_product.uom.id,
-                        'cost_price': extra_product.cost_price,
-                    })
-            data = [('remove', [ep.id for ep in move.extra_products])]
-            if create:
-                data.append(('create', create))
-            Move.write([move], {'extra_products': data})
+        productions = Production.browse(context['active_ids'])
+        with measure('production.bom.extra_product.add',
+                len(productions)):
+            Production.add_extra_products_from_bom(productions)
         return 'end'
@@ -1,6 +1,7 @@
 # This file is part of the stock_move_extra_products_supply module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from trytond.model import fields
 from trytond.pool import PoolMeta
 
 __all__ = ['PurchaseRequest']
@@ -9,6 +10,8 @@ __all__ = ['PurchaseRequest']
 class PurchaseRequest:
     __metaclass__ = PoolMeta
     __name__ = 'purchase.request'
+    extra_products = fields.One2Many('stock.move.extra_product',
+        'purchase_request', 'Extra Products', readonly=True)
 
     @classmethod
     def _get_origin(cls):
@@ -0,0 +1,256 @@
+# This file is part of the stock_move_extra_products_supply module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Command line tools of the stock_move_extra_products_supply module
+
+    python -m trytond.modules.stock_move_extra_products_supply.scripts \
+        -c trytond.conf -d database --company 1 backfill --processes 4
+"""
+import argparse
+import csv
+import datetime
+import json
+import logging
+import multiprocessing
+import time
+
+logger = logging.getLogger(__name__)
+
+_options = None
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def _init(options):
+    'Load the configuration and the pool of the database'
+    global _options
+    from trytond.config import config
+    from trytond.pool import Pool
+    if options.config:
+        config.update_etc(options.config)
+    Pool.start()
+    Pool(options.database).init()
+    _options = options
+
+
+def _start_transaction(options, readonly=False):
+    from trytond.transaction import Transaction
+    context = {}
+    if options.company:
+        context['company'] = options.company
+    return Transaction().start(options.database, options.user,
+        readonly=readonly, context=context)
+
+
+def _iter_backfill_chunks(options):
+    'Return the (first id, last id) of the chunks to backfill'
+    from trytond.pool import Pool
+    chunks = []
+    with _start_transaction(options, readonly=True) as transaction:
+        ExtraProduct = Pool().get('stock.move.extra_product')
+        cursor = transaction.connection.cursor()
+        last_id = options.start_id
+        while True:
+            cursor.execute(*ExtraProduct._get_missing_purchase_request_query(
+                    after_id=last_id, limit=options.chunk_size))
+            ids = [r[0] for r in cursor.fetchall()]
+            if not ids:
+                break
+            chunks.append((ids[0], ids[-1]))
+            last_id = ids[-1]
+    return chunks
+
+
+def _backfill_chunk(chunk):
+    'Process the chunk in its own transaction'
+    from trytond.pool import Pool
+    first_id, last_id = chunk
+    with _start_transaction(_options) as transaction:
+        ExtraProduct = Pool().get('stock.move.extra_product')
+        try:
+            count = ExtraProduct.backfill_purchase_requests(first_id, last_id)
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            logger.exception('Fail to backfill extra products %s to %s',
+                first_id, last_id)
+            return chunk, 0, False
+    return chunk, count, True
+
+
+def backfill(options):
+    """Create the missing purchase requests of the extra products of assigned
+    and done moves
+
+    The extra products are split in chunks with keyset pagination and each
+    chunk is processed in its own transaction by a pool of processes. Running
+    it again resumes the work as the processed extra products have a request.
+    """
+    # The workers are forked before any database connection is opened
+    pool = None
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes,
+            initializer=_init, initargs=(options,))
+    _init(options)
+    chunks = _iter_backfill_chunks(options)
+    logger.info('%d chunks to backfill', len(chunks))
+    if pool:
+        results = pool.imap_unordered(_backfill_chunk, chunks)
+    else:
+        results = (_backfill_chunk(c) for c in chunks)
+
+    start = time.time()
+    total = failed = 0
+    for i, (chunk, count, success) in enumerate(results, 1):
+        total += count
+        if not success:
+            failed += 1
+        elapsed = time.time() - start
+        logger.info('%d/%d chunks, %d extra products in %.1fs (%.1f/s), '
+            'last chunk %s-%s', i, len(chunks), total, elapsed,
+            total / elapsed if elapsed else 0, chunk[0], chunk[1])
+    if pool:
+        pool.close()
+        pool.join()
+    if failed:
+        logger.warning('%d chunks failed, run it again to retry them', failed)
+    return not failed
+
+
+def _format_value(value):
+    'Return the value as text for the csv module of the Python version'
+    if value is None:
+        return ''
+    if not isinstance(value, text_type):
+        value = text_type(value)
+    if str is bytes:
+        # The csv module of Python 2 only writes bytes
+        return value.encode('utf-8')
+    return value
+
+
+def _open_output(filename):
+    'Open the output file to write UTF-8 text'
+    if str is bytes:
+        return open(filename, 'wb')
+    return open(filename, 'w', encoding='utf-8', newline='')
+
+
+def export(options):
+    """Write the extra products with their purchase request status to the
+    output file as CSV or JSON lines
+
+    The rows are streamed from a server-side cursor to the file so the memory
+    usage is constant.
+    """
+    from trytond.pool import Pool
+    _init(options)
+    with _start_transaction(options, readonly=True):
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+        Location = pool.get('stock.location')
+        Company = pool.get('company.company')
+        rows = ExtraProduct.export_rows(
+            from_date=options.from_date,
+            to_date=options.to_date,
+            warehouse=(Location(options.warehouse)
+                if options.warehouse else None),
+            company=Company(options.company) if options.company else None)
+        count = 0
+        with _open_output(options.output) as output:
+            if options.format == 'csv':
+                writer = None
+                for row in rows:
+                    if writer is None:
+                        writer = csv.DictWriter(output,
+                            sorted(row.keys()))
+                        writer.writeheader()
+                    writer.writerow(dict((k, _format_value(v))
+                            for k, v in row.items()))
+                    count += 1
+            else:
+                for row in rows:
+                    output.write(json.dumps(row, default=str,
+                            sort_keys=True))
+                    output.write('\n')
+                    count += 1
+    logger.info('%d extra products exported to %s', count, options.output)
+    return True
+
+
+def recompute_cost(options):
+    """Update the cost price of the extra products of moves that are not done
+    and of BOM inputs and outputs with the current cost price of products
+
+    The cost price of products depends on the company, so only the moves of
+    the company are updated.
+    """
+    from trytond.pool import Pool
+    if not options.company:
+        logger.error('--company is required to recompute the cost')
+        return False
+    _init(options)
+    with _start_transaction(options) as transaction:
+        pool = Pool()
+        for model in ['stock.move.extra_product',
+                'production.bom.input.extra_product',
+                'production.bom.output.extra_product']:
+            pool.get(model).recompute_cost_price()
+        transaction.commit()
+    return True
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Tools of the stock_move_extra_products_supply module')
+    parser.add_argument('-c', '--config', dest='config',
+        help='trytond configuration file')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='user', type=int, default=0,
+        help='id of the user')
+    parser.add_argument('--company', dest='company', type=int,
+        help='id of the company')
+    subparsers = parser.add_subparsers(dest='command')
+
+    backfill_parser = subparsers.add_parser('backfill',
+        help='create the missing purchase requests of extra products')
+    backfill_parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+        default=500)
+    backfill_parser.add_argument('--processes', dest='processes', type=int,
+        default=multiprocessing.cpu_count())
+    backfill_parser.add_argument('--start-id', dest='start_id', type=int,
+        default=0, help='resume after this extra product id')
+    backfill_parser.set_defaults(func=backfill)
+
+    export_parser = subparsers.add_parser('export',
+        help='export the extra products with their purchase request status')
+    export_parser.add_argument('output', help='output file')
+    export_parser.add_argument('--format', dest='format',
+        choices=['csv', 'json'], default='csv')
+    export_parser.add_argument('--from-date', dest='from_date', type=_date,
+        help='first date (YYYY-MM-DD) of the moves')
+    export_parser.add_argument('--to-date', dest='to_date', type=_date,
+        help='last date (YYYY-MM-DD) of the moves')
+    export_parser.add_argument('--warehouse', dest='warehouse', type=int,
+        help='id of the warehouse')
+    export_parser.set_defaults(func=export)
+
+    recompute_cost_parser = subparsers.add_parser('recompute-cost',
+        help='update the cost price of extra products of the company')
+    recompute_cost_parser.set_defaults(func=recompute_cost)
+
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if not options.func(options):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,5 +13,8 @@ class ShipmentOut:
         'Return inventory move for the outgoing move: copy of extra products'
         ExtraProduct = Pool().get('stock.move.extra_product')
         inventory_move = super(ShipmentOut, self)._get_inventory_move(move)
-        inventory_move.extra_products = ExtraProduct.copy(move.extra_products)
+        # The copies are created when the inventory moves are saved
+        inventory_move.extra_products = [
+            ExtraProduct(**extra._get_copy_values())
+            for extra in move.extra_products]
         return inventory_move
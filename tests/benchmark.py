@@ -0,0 +1,262 @@
+# This file is part of the stock_move_extra_products_supply module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""Benchmark of the extra products supply hot paths
+
+It generates synthetic moves, shipments and productions with extra products
+on the test database (see DB_NAME and TRYTOND_DATABASE_URI) and reports the
+wall time, the SQL queries and the rows written by each operation:
+
+    python -m trytond.modules.stock_move_extra_products_supply.tests.benchmark \
+        --moves 500 --extra-products 3 --productions 50
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import time
+from decimal import Decimal
+
+from trytond.tests.test_tryton import install_module, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.stock_move_extra_products_supply.instrument import (
+    QueryCounter)
+
+MODULE = 'stock_move_extra_products_supply'
+
+
+def measure(results, name, func, *args):
+    'Run func and append its wall time, queries and rows written to results'
+    transaction = Transaction()
+    connection = transaction.connection
+    counter = transaction.connection = QueryCounter(connection)
+    start = time.time()
+    try:
+        value = func(*args)
+    finally:
+        transaction.connection = connection
+    results.append((name, time.time() - start, counter.queries, counter.rows))
+    return value
+
+
+class Benchmark(object):
+    'Generate the synthetic data and time the operations'
+
+    def __init__(self, moves, extra_products, productions):
+        self.nb_moves = moves
+        self.nb_extra_products = extra_products
+        self.nb_productions = productions
+        self.results = []
+
+    def run(self, company):
+        pool = Pool()
+        Production = pool.get('production')
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        self.setup(company)
+
+        moves = self.create_moves(self.storage, self.internal)
+        measure(self.results, 'Move.assign', Move.assign, moves)
+
+        moves = self.create_moves(self.supplier, self.storage,
+            unit_price=Decimal('10'), currency=self.company.currency.id)
+        measure(self.results, 'Move.do', Move.do, moves)
+
+        moves = self.create_moves(self.storage, self.internal)
+        measure(self.results, 'Move.create_extra_purchase_requests',
+            Move.create_extra_purchase_requests, moves)
+
+        shipment = self.create_shipment_out()
+        measure(self.results, 'ShipmentOut.wait (_get_inventory_move)',
+            ShipmentOut.wait, [shipment])
+
+        productions = self.create_productions()
+        measure(self.results, 'AddExtraProductBOM.transition_add_',
+            self.run_wizard, productions)
+        measure(self.results, 'Production.extra_products_cost',
+            Production.read, [p.id for p in productions],
+            ['extra_products_cost'])
+        return self.results
+
+    def setup(self, company):
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Party = pool.get('party.party')
+
+        self.company = company
+        self.unit, = Uom.search([('name', '=', 'Unit')])
+        self.warehouse, = Location.search([('code', '=', 'WH')])
+        self.storage, = Location.search([('code', '=', 'STO')])
+        self.output, = Location.search([('code', '=', 'OUT')])
+        self.supplier, = Location.search([('code', '=', 'SUP')])
+        self.customer, = Location.search([('code', '=', 'CUS')])
+        self.internal, = Location.create([{
+                    'name': 'Internal',
+                    'type': 'storage',
+                    'parent': self.storage.id,
+                    }])
+        self.production_location, = Location.create([{
+                    'name': 'Production',
+                    'type': 'production',
+                    }])
+        self.supplier_party, self.customer_party = Party.create([{
+                    'name': 'Supplier',
+                    }, {
+                    'name': 'Customer',
+                    'addresses': [('create', [{}])],
+                    }])
+        self.product = self.create_product('Product', 'goods')
+        self.component = self.create_product('Component', 'goods')
+        self.services = [self.create_product('Service %s' % i, 'service')
+            for i in range(self.nb_extra_products)]
+
+    def create_product(self, name, type_):
+        pool = Pool()
+        Template = pool.get('product.template')
+        template, = Template.create([{
+                    'name': name,
+                    'type': type_,
+                    'purchasable': True,
+                    'list_price': Decimal('20'),
+                    'cost_price': Decimal('10'),
+                    'default_uom': self.unit.id,
+                    'purchase_uom': self.unit.id,
+                    'products': [('create', [{}])],
+                    }])
+        product, = template.products
+        return product
+
+    def extra_products_values(self):
+        return [('create', [{
+                        'product': s.id,
+                        'uom': self.unit.id,
+                        'quantity': 1,
+                        'cost_price': Decimal('1'),
+                        } for s in self.services])]
+
+    def create_moves(self, from_location, to_location, **values):
+        Move = Pool().get('stock.move')
+        values.update({
+                'product': self.product.id,
+                'uom': self.unit.id,
+                'quantity': 1,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'planned_date': datetime.date.today(),
+                'company': self.company.id,
+                'extra_products': self.extra_products_values(),
+                })
+        return Move.create([values.copy() for _ in range(self.nb_moves)])
+
+    def create_shipment_out(self):
+        ShipmentOut = Pool().get('stock.shipment.out')
+        shipment, = ShipmentOut.create([{
+                    'customer': self.customer_party.id,
+                    'delivery_address': self.customer_party.addresses[0].id,
+                    'warehouse': self.warehouse.id,
+                    'company': self.company.id,
+                    'outgoing_moves': [('create', [{
+                                    'product': self.product.id,
+                                    'uom': self.unit.id,
+                                    'quantity': 1,
+                                    'from_location': self.output.id,
+                                    'to_location': self.customer.id,
+                                    'planned_date': datetime.date.today(),
+                                    'company': self.company.id,
+                                    'unit_price': Decimal('20'),
+                                    'currency': self.company.currency.id,
+                                    'extra_products': (
+                                        self.extra_products_values()),
+                                    } for _ in range(self.nb_moves)])],
+                    }])
+        return shipment
+
+    def create_productions(self):
+        pool = Pool()
+        BOM = pool.get('production.bom')
+        Production = pool.get('production')
+
+        bom, = BOM.create([{
+                    'name': 'BOM',
+                    'inputs': [('create', [{
+                                    'product': self.component.id,
+                                    'uom': self.unit.id,
+                                    'quantity': 1,
+                                    'extra_products': (
+                                        self.extra_products_values()),
+                                    }])],
+                    'outputs': [('create', [{
+                                    'product': self.product.id,
+                                    'uom': self.unit.id,
+                                    'quantity': 1,
+                                    'extra_products': (
+                                        self.extra_products_values()),
+                                    }])],
+                    }])
+
+        def move(product, from_location, to_location):
+            return {
+                'product': product.id,
+                'uom': self.unit.id,
+                'quantity': 1,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'company': self.company.id,
+                }
+        return Production.create([{
+                    'company': self.company.id,
+                    'warehouse': self.warehouse.id,
+                    'location': self.production_location.id,
+                    'product': self.product.id,
+                    'bom': bom.id,
+                    'uom': self.unit.id,
+                    'quantity': 1,
+                    'inputs': [('create', [move(self.component,
+                                    self.storage, self.production_location)])],
+                    'outputs': [('create', [move(self.product,
+                                    self.production_location, self.storage)])],
+                    } for _ in range(self.nb_productions)])
+
+    def run_wizard(self, productions):
+        AddExtraProductBOM = Pool().get('production.bom.extra_product.add',
+            type='wizard')
+        session_id, _, _ = AddExtraProductBOM.create()
+        wizard = AddExtraProductBOM(session_id)
+        with Transaction().set_context(
+                active_ids=[p.id for p in productions]):
+            wizard.transition_add_()
+        AddExtraProductBOM.delete(session_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the extra products supply operations')
+    parser.add_argument('--moves', type=int, default=100,
+        help='number of moves per operation')
+    parser.add_argument('--extra-products', dest='extra_products', type=int,
+        default=3, help='number of extra products per move')
+    parser.add_argument('--productions', type=int, default=20,
+        help='number of productions')
+    options = parser.parse_args()
+
+    install_module(MODULE)
+
+    @with_transaction()
+    def run():
+        benchmark = Benchmark(options.moves, options.extra_products,
+            options.productions)
+        company = create_company()
+        with set_company(company):
+            return benchmark.run(company)
+
+    print('%-40s %10s %10s %10s' % ('Operation', 'Time (s)', 'Queries',
+            'Rows'))
+    for name, duration, queries, rows in run():
+        print('%-40s %10.3f %10d %10d' % (name, duration, queries, rows))
+
+
+if __name__ == '__main__':
+    main()
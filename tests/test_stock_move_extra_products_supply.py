@@ -1,15 +1,635 @@
 # This file is part of the stock_move_extra_products_supply module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
 import unittest
+from decimal import Decimal
+
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.stock_move_extra_products_supply.move import (
+    PURCHASE_REQUEST_LOCK)
+from trytond.modules.stock_move_extra_products_supply.tests.benchmark import (
+    Benchmark)
 
 
 class StockMoveExtraProductsSupplyTestCase(ModuleTestCase):
     'Test Stock Move Extra Products Supply module'
     module = 'stock_move_extra_products_supply'
 
+    def create_data(self, company, moves=1, extra_products=1, productions=1):
+        'Return the benchmark with the locations, parties and products'
+        data = Benchmark(moves, extra_products, productions)
+        data.setup(company)
+        return data
+
+    def set_configuration(self, **values):
+        Configuration = Pool().get('stock.configuration')
+        Configuration.write([Configuration(1)], values)
+
+    @with_transaction()
+    def test_group_purchase_requests(self):
+        'Test the purchase requests of extra products are grouped'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Request = pool.get('purchase.request')
+
+        company = create_company()
+        with set_company(company):
+            self.set_configuration(extra_products_group_requests=True)
+            data = self.create_data(company, moves=2)
+            moves = data.create_moves(data.storage, data.internal)
+            Move.assign(moves)
+
+            request, = Request.search([])
+            self.assertEqual(request.product, data.services[0])
+            self.assertEqual(request.quantity, 2)
+            self.assertEqual(request.computed_quantity, 2)
+            self.assertEqual(len(request.extra_products), 2)
+
+    @with_transaction()
+    def test_resync_purchase_requests(self):
+        'Test the outdated extra products update their purchase requests'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ExtraProduct = pool.get('stock.move.extra_product')
+        Request = pool.get('purchase.request')
+
+        company = create_company()
+        with set_company(company):
+            self.set_configuration(extra_products_group_requests=True)
+            data = self.create_data(company, moves=2)
+            moves = data.create_moves(data.storage, data.internal)
+            Move.assign(moves)
+            extra, other = ExtraProduct.search([], order=[('id', 'ASC')])
+            self.assertFalse(extra.purchase_request_dirty)
+
+            tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+            Move.write([extra.move], {
+                    'planned_date': tomorrow,
+                    })
+            extra, other = ExtraProduct.search([], order=[('id', 'ASC')])
+            self.assertTrue(extra.purchase_request_dirty)
+            self.assertFalse(other.purchase_request_dirty)
+
+            ExtraProduct.resync_purchase_requests()
+            extra, other = ExtraProduct.search([], order=[('id', 'ASC')])
+            self.assertFalse(extra.purchase_request_dirty)
+            self.assertNotEqual(extra.purchase_request, other.purchase_request)
+            self.assertEqual(extra.purchase_request.supply_date, tomorrow)
+            self.assertEqual(extra.purchase_request.quantity, 1)
+            self.assertEqual(other.purchase_request.supply_date,
+                datetime.date.today())
+            self.assertEqual(other.purchase_request.quantity, 1)
+            self.assertEqual(Request.search([], count=True), 2)
+
+    @with_transaction()
+    def test_queue(self):
+        'Test the queue of moves to create the purchase requests'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ExtraProduct = pool.get('stock.move.extra_product')
+        Queue = pool.get('stock.move.extra_product.queue')
+
+        company = create_company()
+        with set_company(company):
+            self.set_configuration(extra_products_async_requests=True)
+            data = self.create_data(company)
+            move, = data.create_moves(data.storage, data.internal)
+            Move.assign([move])
+            Queue.enqueue([move])
+
+            queue, = Queue.search([])
+            self.assertEqual(queue.move, move)
+            extra, = ExtraProduct.search([])
+            self.assertIsNone(extra.purchase_request)
+
+            for attempts in range(1, Queue.max_attempts):
+                Queue.increase_attempts([queue])
+                queue = Queue(queue.id)
+                self.assertEqual(queue.attempts, attempts)
+                self.assertEqual(queue.state, 'waiting')
+            Queue.increase_attempts([queue])
+            queue = Queue(queue.id)
+            self.assertEqual(queue.attempts, Queue.max_attempts)
+            self.assertEqual(queue.state, 'failed')
+
+            Queue.retry([queue])
+            queue = Queue(queue.id)
+            self.assertEqual(queue.attempts, 0)
+            self.assertEqual(queue.state, 'waiting')
+
+            Queue._process([(queue.id, move.id)])
+            self.assertEqual(Queue.search([], count=True), 0)
+            extra, = ExtraProduct.search([])
+            self.assertIsNotNone(extra.purchase_request)
+
+    @with_transaction()
+    def test_recompute_cost_price(self):
+        'Test the cost price of extra products is recomputed by company'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ExtraProduct = pool.get('stock.move.extra_product')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        other_company = create_company('Other', currency=company.currency)
+        with set_company(company):
+            data = self.create_data(company)
+            move, = data.create_moves(data.storage, data.internal)
+            data.company = other_company
+            other_move, = data.create_moves(data.storage, data.internal)
+            service, = data.services
+            Template.write([service.template], {
+                    'cost_price': Decimal('4'),
+                    })
+
+            ExtraProduct.recompute_cost_price()
+            # The costs are stored with SQL
+            costs = dict((v['move'], v['cost_price'])
+                for v in ExtraProduct.read(
+                    [e.id for e in ExtraProduct.search([])],
+                    ['move', 'cost_price']))
+            self.assertEqual(costs, {
+                    move.id: Decimal('4'),
+                    other_move.id: Decimal('1'),
+                    })
+            move_costs = dict((v['id'], v['extra_products_cost'])
+                for v in Move.read([move.id, other_move.id],
+                    ['extra_products_cost']))
+            self.assertEqual(move_costs, {
+                    move.id: Decimal('4'),
+                    other_move.id: Decimal('1'),
+                    })
+
+    @with_transaction()
+    def test_copy_move(self):
+        'Test copy of moves with extra products'
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        def cost(move):
+            # The cost is stored with SQL
+            value, = Move.read([move.id], ['extra_products_cost'])
+            return value['extra_products_cost']
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company, extra_products=2)
+            move, = data.create_moves(data.storage, data.internal)
+            Move.assign([move])
+            self.assertEqual(cost(move), Decimal('2'))
+
+            new_move, = Move.copy([move])
+            self.assertEqual(len(new_move.extra_products), 2)
+            self.assertEqual(
+                sorted(e.product.id for e in new_move.extra_products),
+                sorted(e.product.id for e in move.extra_products))
+            self.assertTrue(all(e.purchase_request is None
+                    for e in new_move.extra_products))
+            self.assertEqual(cost(new_move), Decimal('2'))
+
+            new_move, = Move.copy([move], default={
+                    'extra_products': None,
+                    })
+            self.assertEqual(new_move.extra_products, ())
+            self.assertIsNone(cost(new_move))
+
+    def create_bom(self, data, inputs, outputs):
+        'Create a BOM with the (product, quantity, services) lines'
+        pool = Pool()
+        BOM = pool.get('production.bom')
+
+        def lines(values):
+            return [('create', [{
+                            'product': product.id,
+                            'uom': data.unit.id,
+                            'quantity': quantity,
+                            'extra_products': [('create', [{
+                                            'product': s.id,
+                                            'uom': data.unit.id,
+                                            'quantity': 1,
+                                            'cost_price': Decimal('1'),
+                                            } for s in services])],
+                            } for product, quantity, services in values])]
+        bom, = BOM.create([{
+                    'name': 'BOM',
+                    'inputs': lines(inputs),
+                    'outputs': lines(outputs),
+                    }])
+        return bom
+
+    def set_bom(self, product, bom):
+        Product = Pool().get('product.product')
+        Product.write([product], {
+                'boms': [('create', [{
+                                'bom': bom.id,
+                                }])],
+                })
+
+    @with_transaction()
+    def test_explode_extra_products(self):
+        'Test the extra products of the BOMs of the inputs are rolled up'
+        pool = Pool()
+        BOM = pool.get('production.bom')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company, extra_products=4)
+            parent_service, input_service, output_service, by_service = (
+                data.services)
+            material = data.create_product('Material', 'goods')
+            by_product = data.create_product('By-product', 'goods')
+            child = self.create_bom(data,
+                [(material, 1, [input_service])],
+                [(data.component, 2, [output_service]),
+                    (by_product, 1, [by_service])])
+            self.set_bom(data.component, child)
+            parent = self.create_bom(data,
+                [(data.component, 1, [parent_service])],
+                [(data.product, 1, [])])
+
+            result = BOM(parent.id).explode_extra_products()
+            extras = dict((v['product'], (v['quantity'], v['cost_price']))
+                for v in result[('input', data.component.id)])
+            # The child BOM produces 2 units for the 1 unit of the input
+            self.assertEqual(extras, {
+                    parent_service.id: (1, Decimal('1')),
+                    input_service.id: (0.5, Decimal('0.5')),
+                    output_service.id: (0.5, Decimal('0.5')),
+                    })
+            self.assertEqual(result[('output', data.product.id)], [])
+
+    @with_transaction()
+    def test_explode_extra_products_own_input(self):
+        'Test a BOM producing its own input is not exploded again'
+        pool = Pool()
+        BOM = pool.get('production.bom')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company, extra_products=2)
+            input_service, output_service = data.services
+            bom = self.create_bom(data,
+                [(data.product, 1, [input_service])],
+                [(data.product, 2, [output_service])])
+            self.set_bom(data.product, bom)
+
+            result = BOM(bom.id).explode_extra_products()
+            extras = [v['product']
+                for v in result[('input', data.product.id)]]
+            self.assertEqual(extras, [input_service.id])
+
+    @with_transaction()
+    def test_explode_extra_products_recursive(self):
+        'Test the explosion of recursive BOMs raises an error'
+        pool = Pool()
+        BOM = pool.get('production.bom')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company)
+            first = self.create_bom(data,
+                [(data.component, 1, data.services)],
+                [(data.product, 1, [])])
+            second = self.create_bom(data,
+                [(data.product, 1, data.services)],
+                [(data.component, 1, [])])
+            self.set_bom(data.component, second)
+            self.set_bom(data.product, first)
+
+            self.assertRaises(UserError,
+                BOM(first.id).explode_extra_products)
+
+    @with_transaction()
+    def test_sync_extra_products_from_bom(self):
+        'Test the extra products of productions follow their BOM'
+        pool = Pool()
+        Production = pool.get('production')
+        ExtraProduct = pool.get('stock.move.extra_product')
+
+        company = create_company()
+        with set_company(company):
+            self.set_configuration(extra_products_from_bom=True)
+            data = self.create_data(company)
+            production, = data.create_productions()
+            input_, = production.inputs
+            output, = production.outputs
+            bom_extra, = input_.extra_products
+            self.assertTrue(bom_extra.from_bom)
+            self.assertEqual(bom_extra.quantity, 1)
+            self.assertEqual(len(output.extra_products), 1)
+
+            manual_extra, = ExtraProduct.create([{
+                        'move': input_.id,
+                        'product': data.services[0].id,
+                        'uom': data.unit.id,
+                        'quantity': 5,
+                        'cost_price': Decimal('5'),
+                        }])
+            Production.write([production], {
+                    'quantity': 2,
+                    })
+
+            extras = ExtraProduct.search([
+                    ('move', '=', input_.id),
+                    ], order=[('id', 'ASC')])
+            self.assertEqual([e.id for e in extras],
+                [bom_extra.id, manual_extra.id])
+            bom_extra, manual_extra = extras
+            self.assertEqual(bom_extra.quantity, 2)
+            self.assertEqual(bom_extra.cost_price, Decimal('2'))
+            self.assertEqual(manual_extra.quantity, 5)
+            self.assertFalse(manual_extra.from_bom)
+
+    def create_production(self, data, bom, **values):
+        Production = Pool().get('production')
+        production = Production(
+            company=data.company,
+            warehouse=data.warehouse,
+            location=data.production_location,
+            product=data.product,
+            bom=bom,
+            uom=data.unit,
+            quantity=2,
+            **values)
+        return production
+
+    @with_transaction()
+    def test_backfill_purchase_requests(self):
+        'Test backfill of the purchase requests of existing moves'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ExtraProduct = pool.get('stock.move.extra_product')
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company)
+            assigned, = data.create_moves(data.storage, data.internal)
+            done, = data.create_moves(data.supplier, data.storage,
+                unit_price=Decimal('10'), currency=company.currency.id)
+            draft, = data.create_moves(data.storage, data.internal)
+            # Moves processed before the module was installed
+            Move.write([assigned], {'state': 'assigned'})
+            Move.write([done], {'state': 'done'})
+
+            cursor.execute(*ExtraProduct._get_missing_purchase_request_query())
+            ids = [r[0] for r in cursor.fetchall()]
+            expected = [e.id for m in [assigned, done]
+                for e in m.extra_products]
+            self.assertEqual(ids, sorted(expected))
+
+            self.assertEqual(
+                ExtraProduct.backfill_purchase_requests(ids[0], ids[-1]), 2)
+            for extra in ExtraProduct.browse(expected):
+                self.assertIsNotNone(extra.purchase_request)
+            extra, = draft.extra_products
+            self.assertIsNone(extra.purchase_request)
+            self.assertEqual(
+                ExtraProduct.backfill_purchase_requests(ids[0], ids[-1]), 0)
+
+    @with_transaction()
+    def test_export_rows(self):
+        'Test export of the extra products with their request state'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ExtraProduct = pool.get('stock.move.extra_product')
+        Purchase = pool.get('purchase.purchase')
+        Request = pool.get('purchase.request')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company)
+            assigned, purchased, draft = [
+                data.create_moves(data.storage, data.internal)[0]
+                for _ in range(3)]
+            done, = data.create_moves(data.supplier, data.storage,
+                unit_price=Decimal('10'), currency=company.currency.id)
+            Move.assign([assigned, purchased])
+            Move.do([done])
+
+            purchase, = Purchase.create([{
+                        'company': company.id,
+                        'party': data.supplier_party.id,
+                        'currency': company.currency.id,
+                        'warehouse': data.warehouse.id,
+                        'lines': [('create', [{
+                                        'product': data.services[0].id,
+                                        'description': 'Service',
+                                        'quantity': 1,
+                                        'unit': data.unit.id,
+                                        'unit_price': Decimal('1'),
+                                        }])],
+                        }])
+            line, = purchase.lines
+            extra, = purchased.extra_products
+            Request.write([extra.purchase_request], {
+                    'purchase_line': line.id,
+                    })
+
+            rows = dict((r['move'], r)
+                for r in ExtraProduct.export_rows())
+            self.assertEqual(set(rows),
+                set(m.id for m in [assigned, purchased, draft, done]))
+            expected = {
+                assigned.id: ('assigned', 'draft', None),
+                done.id: ('done', 'draft', None),
+                purchased.id: ('assigned', 'purchased', 'draft'),
+                draft.id: ('draft', None, None),
+                }
+            for move_id, row in rows.items():
+                self.assertEqual((row['move_state'],
+                        row['purchase_request_state'], row['purchase_state']),
+                    expected[move_id])
+                self.assertEqual(row['quantity'], 1)
+
+            Purchase.write([purchase], {'state': 'cancel'})
+            rows = dict((r['move'], r)
+                for r in ExtraProduct.export_rows())
+            self.assertEqual(rows[purchased.id]['purchase_request_state'],
+                'cancel')
+
+    @with_transaction()
+    def test_extra_product_state(self):
+        'Test get and search of the extra product state'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ExtraProduct = pool.get('stock.move.extra_product')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company, moves=2)
+            move, other = data.create_moves(data.storage, data.internal)
+            Move.assign([move])
+            extra, = move.extra_products
+            other_extra, = other.extra_products
+
+            self.assertEqual(ExtraProduct(extra.id).state, 'assigned')
+            self.assertEqual(ExtraProduct(other_extra.id).state, 'draft')
+            self.assertEqual(ExtraProduct.search([
+                        ('state', '=', 'assigned'),
+                        ]), [extra])
+            self.assertEqual(ExtraProduct.search([
+                        ('state', 'in', ['draft', 'cancel']),
+                        ]), [other_extra])
+
+    @with_transaction()
+    def test_production_extra_products_cost(self):
+        'Test get, search and order of the production extra products cost'
+        pool = Pool()
+        Production = pool.get('production')
+        ExtraProduct = pool.get('stock.move.extra_product')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company, productions=2)
+            production, other = data.create_productions()
+            input_, = production.inputs
+            output, = production.outputs
+            ExtraProduct.create([{
+                        'move': m.id,
+                        'product': data.services[0].id,
+                        'uom': data.unit.id,
+                        'quantity': 1,
+                        'cost_price': cost,
+                        } for m, cost in [
+                        (input_, Decimal('1')), (output, Decimal('2'))]])
+
+            production, other = Production.browse([production.id, other.id])
+            self.assertEqual(production.extra_products_cost, Decimal('3'))
+            self.assertEqual(other.extra_products_cost, Decimal('0'))
+            self.assertEqual(Production.search([
+                        ('extra_products_cost', '=', Decimal('3')),
+                        ]), [production])
+            self.assertEqual(Production.search([
+                        ('extra_products_cost', '<', Decimal('1')),
+                        ]), [other])
+            self.assertEqual(Production.search([],
+                    order=[('extra_products_cost', 'DESC')]),
+                [production, other])
+            self.assertEqual(Production.search([],
+                    order=[('extra_products_cost', 'ASC')]),
+                [other, production])
+
+    @with_transaction()
+    def test_explode_bom_extra_products(self):
+        'Test the extra products of an exploded production are not doubled'
+        company = create_company()
+        with set_company(company):
+            self.set_configuration(extra_products_from_bom=True)
+            data = self.create_data(company)
+            bom = data.create_productions()[0].bom
+            production = self.create_production(data, bom)
+            production.explode_bom()
+            # The client does not send the extra products of the moves
+            for move in list(production.inputs) + list(production.outputs):
+                self.assertFalse(getattr(move, 'extra_products', None))
+            production.save()
+
+            input_, = production.inputs
+            output, = production.outputs
+            for move in [input_, output]:
+                self.assertEqual(
+                    [(e.quantity, e.from_bom) for e in move.extra_products],
+                    [(2, True)])
+
+    @with_transaction()
+    def test_set_moves_extra_products(self):
+        'Test the extra products are added to the generated moves'
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            self.set_configuration(extra_products_from_bom=True)
+            data = self.create_data(company)
+            bom = data.create_productions()[0].bom
+            production = self.create_production(data, bom, state='request')
+            production.save()
+            self.assertEqual(production.inputs, ())
+
+            production.set_moves()
+            production = Production(production.id)
+            input_, = production.inputs
+            output, = production.outputs
+            for move in [input_, output]:
+                self.assertEqual(
+                    [(e.quantity, e.from_bom) for e in move.extra_products],
+                    [(2, True)])
+
+    @with_transaction()
+    def test_migrate_from_bom(self):
+        'Test the migration flags the extra products of the BOM'
+        pool = Pool()
+        ExtraProduct = pool.get('stock.move.extra_product')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company)
+            production, = data.create_productions()
+            input_, = production.inputs
+            other = data.create_product('Other', 'service')
+            bom_extra, manual_extra = ExtraProduct.create([{
+                        'move': input_.id,
+                        'product': p.id,
+                        'uom': data.unit.id,
+                        'quantity': 1,
+                        } for p in [data.services[0], other]])
+            self.assertFalse(bom_extra.from_bom)
+
+            ExtraProduct._migrate_from_bom()
+            # The flag is set with SQL
+            bom_values, manual_values = ExtraProduct.read(
+                [bom_extra.id, manual_extra.id], ['from_bom'])
+            self.assertTrue(bom_values['from_bom'])
+            self.assertFalse(manual_values['from_bom'])
+
+    @unittest.skipIf(backend.name() != 'postgresql',
+        'advisory locks are only used on PostgreSQL')
+    @with_transaction()
+    def test_locked_extra_products_queued(self):
+        'Test extra products locked by another transaction are queued'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ExtraProduct = pool.get('stock.move.extra_product')
+        Queue = pool.get('stock.move.extra_product.queue')
+
+        company = create_company()
+        with set_company(company):
+            data = self.create_data(company)
+            move, = data.create_moves(data.storage, data.internal)
+            extra, = move.extra_products
+
+            # Another transaction is creating the request of the extra product
+            database = Transaction().database
+            connection = database.get_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute('SELECT PG_ADVISORY_XACT_LOCK(%s, %s)',
+                    (PURCHASE_REQUEST_LOCK, extra.id))
+                Move.assign([move])
+            finally:
+                connection.rollback()
+                database.put_connection(connection)
+
+            extra = ExtraProduct(extra.id)
+            self.assertIsNone(extra.purchase_request)
+            queue, = Queue.search([])
+            self.assertEqual(queue.move, move)
+            self.assertEqual(queue.state, 'waiting')
+
+            # Once released the extra product is processed
+            skipped = Move.create_extra_purchase_requests([move])
+            self.assertEqual(skipped, [])
+            extra = ExtraProduct(extra.id)
+            self.assertIsNotNone(extra.purchase_request)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()